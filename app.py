@@ -1,12 +1,20 @@
-from flask import Flask, request, jsonify, send_from_directory, render_template
-from flask_cors import CORS
-import traceback
-from openai import OpenAI
-from anthropic import Anthropic, HUMAN_PROMPT, AI_PROMPT
+from quart import Quart, Response, request, jsonify, render_template, make_response
+from quart.json.provider import DefaultJSONProvider
+from quart_cors import cors
+import asyncio
+import collections
+import functools
+import gzip
+import httpx
+import orjson
+import time
+from openai import AsyncOpenAI
+from anthropic import AsyncAnthropic
 from dotenv import load_dotenv
+from llm_cache import cached, cached_stream, UncachedResult, TRUNCATED
+from local_solver import SolverPool
 import os
 import logging
-import re
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -14,57 +22,175 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Load environment variables from .env file
 load_dotenv()
 
-app = Flask(__name__, static_folder='static', template_folder='static')
-CORS(app)
+class OrjsonProvider(DefaultJSONProvider):
+    # Responses carry KB-sized HTML for both models; orjson encodes them far faster than stdlib json
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app = Quart(__name__, static_folder='static', template_folder='static')
+app.json = OrjsonProvider(app)
+# Match the two-minute budget the app had under Gunicorn; Quart defaults to 60s
+app.config['RESPONSE_TIMEOUT'] = 120
+app = cors(app)
+
+# One keep-alive HTTP/2 pool shared by both SDKs, so concurrent requests to a provider
+# multiplex over a single TCP/TLS connection instead of handshaking per connection
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=120,
+    limits=httpx.Limits(max_connections=128, max_keepalive_connections=64)
+)
 
 # OpenAI client
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client)
 
 # Anthropic client
-anthropic_client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+anthropic_client = AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), http_client=http_client)
+
+@app.after_serving
+async def close_http_client():
+    await http_client.aclose()
+
+CLAUDE_MODEL = "claude-3-5-sonnet-20241022"
+GPT4_MODEL = "gpt-4"
+
+# Short computational problems go to the faster tier of each provider, falling back to
+# the full model if the fast one fails
+MODEL_TIERS = {
+    'claude': {'fast': "claude-3-haiku-20240307", 'full': CLAUDE_MODEL},
+    'gpt4': {'fast': "gpt-4o-mini", 'full': GPT4_MODEL},
+}
+COMPUTATIONAL_TYPES = ('derivative', 'integral', 'limit', 'solve', 'math')
+SHORT_QUESTION_LENGTH = 80
+# Budget for retrying a solve whose first answer was cut off
+FULL_MAX_TOKENS = 2000
+
+# "dual" asks both models and shows both answers; "fast" asks only the one suited to the problem type
+SOLVE_MODES = ('dual', 'fast')
+FAST_MODEL_BY_TYPE = {
+    'law': 'claude',
+    'business': 'claude',
+    'science': 'claude',
+}
+
+# Seconds to wait on sympy before handing a problem to the LLMs
+LOCAL_SOLVE_TIMEOUT = 2
+LOCAL_SOLVE_PROCESSES = int(os.getenv('LOCAL_SOLVE_PROCESSES', 2))
+local_solver_pool = SolverPool(LOCAL_SOLVE_PROCESSES, LOCAL_SOLVE_TIMEOUT)
+
+@app.before_serving
+async def start_local_solver_pool():
+    # Workers take a moment to import sympy; start them before the first request arrives
+    await local_solver_pool.start()
+
+@app.after_serving
+async def close_local_solver_pool():
+    await local_solver_pool.close()
+
+# Under a provider outage every request fails the same way; log the first few of each kind
+# in a window in full, then only a sample, so logging doesn't amplify the outage
+ERROR_LOG_WINDOW = 60
+ERROR_LOG_BURST = 10
+ERROR_LOG_SAMPLE_RATE = 100
+error_counts = collections.Counter()
+error_window_start = time.monotonic()
+
+def log_error(where, e):
+    global error_window_start
+    now = time.monotonic()
+    if now - error_window_start > ERROR_LOG_WINDOW:
+        error_counts.clear()
+        error_window_start = now
+    key = (where, type(e).__name__)
+    error_counts[key] += 1
+    count = error_counts[key]
+    if count <= ERROR_LOG_BURST or count % ERROR_LOG_SAMPLE_RATE == 0:
+        # exc_info defers traceback formatting to handlers that actually emit the record
+        app.logger.error(f"Error in {where} ({count} in window): {str(e)}", exc_info=e)
 
 # Adjust SSL-related logging
 logging.getLogger('urllib3.connectionpool').setLevel(logging.WARNING)
 
+# The pages have no per-request template variables, so render and gzip them once at startup
+PAGES = ('index', 'math', 'science', 'law', 'business')
+rendered_pages = {}
+
+@app.before_serving
+async def prerender_pages():
+    for name in PAGES:
+        async with app.test_request_context('/'):
+            html = (await render_template(f'{name}.html')).encode()
+        rendered_pages[name] = (html, gzip.compress(html))
+
+def page_response(name):
+    html, gzipped = rendered_pages[name]
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = Response(gzipped, mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(html, mimetype='text/html')
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
 @app.route('/')
-def index():
-    return render_template('index.html')
+async def index():
+    return page_response('index')
 
 @app.route('/math')
-def math():
-    return render_template('math.html')
+async def math():
+    return page_response('math')
 
 @app.route('/science')
-def science():
-    return render_template('science.html')
+async def science():
+    return page_response('science')
 
 @app.route('/law')
-def law():
-    return render_template('law.html')
+async def law():
+    return page_response('law')
 
 @app.route('/business')
-def business():
-    return render_template('business.html')
+async def business():
+    return page_response('business')
 
 @app.route('/api/solve', methods=['POST'])
-def solve_problem():
+async def solve_problem():
     try:
-        data = request.json
+        data = await request.get_json()
         if not data:
             return jsonify({'error': 'No JSON data received'}), 400
 
         problem_type = data.get('problemType')
         question = data.get('question')
 
+        explain_with_llm = data.get('explainWithLlm', False)
+        mode = data.get('mode', 'dual')
+
         if not problem_type or not question:
             return jsonify({'error': 'Invalid input'}), 400
 
+        if mode not in SOLVE_MODES:
+            return jsonify({'error': 'Invalid mode specified'}), 400
+
         logging.info(f"Received request - Problem Type: {problem_type}, Question: {question}")
 
-        claude_result = solve_with_claude(problem_type, question)
-        gpt4_result = solve_with_gpt4(problem_type, question)
+        if explain_with_llm:
+            local_result, (claude_result, gpt4_result) = await asyncio.gather(
+                solve_locally(problem_type, question),
+                solve_with_llms(problem_type, question, mode)
+            )
+        else:
+            # Simple algebra and calculus is answered by sympy without touching either provider
+            local_result = await solve_locally(problem_type, question)
+            if local_result is not None:
+                claude_result = gpt4_result = None
+            else:
+                claude_result, gpt4_result = await solve_with_llms(problem_type, question, mode)
 
         return jsonify({
+            'local_result': local_result,
             'claude_result': claude_result,
             'gpt4_result': gpt4_result,
             'problem_type': problem_type,
@@ -72,14 +198,61 @@ def solve_problem():
         })
     except Exception as e:
         error_msg = f"An error occurred: {str(e)}"
-        app.logger.error(error_msg)
-        app.logger.error(traceback.format_exc())
+        log_error('solve_problem', e)
+        return jsonify({'error': error_msg}), 500
+
+@app.route('/api/solve/stream', methods=['POST'])
+async def solve_problem_stream():
+    try:
+        data = await request.get_json()
+        if not data:
+            return jsonify({'error': 'No JSON data received'}), 400
+
+        model = data.get('model')
+        problem_type = data.get('problemType')
+        question = data.get('question')
+
+        if not model or not problem_type or not question:
+            return jsonify({'error': 'Invalid input'}), 400
+
+        if model == 'claude':
+            streamer = stream_with_claude
+        elif model == 'gpt4':
+            streamer = stream_with_gpt4
+        else:
+            return jsonify({'error': 'Invalid model specified'}), 400
+
+        # Tokens are sent as they arrive, so a stream can't fall back to the full model
+        tier = 'fast' if is_short_problem(problem_type, question) else 'full'
+        model_name = MODEL_TIERS[model][tier]
+
+        logging.info(f"Received stream request - Model: {model}, Problem Type: {problem_type}, Question: {question}")
+
+        # Server-sent events: token deltas as they arrive, then the formatted result
+        async def generate():
+            try:
+                async for event in streamer(problem_type, question, model_name):
+                    yield f"data: {app.json.dumps(event)}\n\n"
+            except Exception as e:
+                log_error(streamer.__name__, e)
+                yield f"data: {app.json.dumps({'error': f'Error: {str(e)}'})}\n\n"
+
+        response = await make_response(generate(), {
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache'
+        })
+        # Long completions can outlive Quart's default response timeout
+        response.timeout = None
+        return response
+    except Exception as e:
+        error_msg = f"An error occurred: {str(e)}"
+        log_error('solve_problem_stream', e)
         return jsonify({'error': error_msg}), 500
 
 @app.route('/api/chat', methods=['POST'])
-def chat():
+async def chat():
     try:
-        data = request.json
+        data = await request.get_json()
         if not data:
             return jsonify({'error': 'No JSON data received'}), 400
 
@@ -94,92 +267,212 @@ def chat():
         logging.info(f"Received chat request - Model: {model}, Message: {message}, Problem Type: {problem_type}")
 
         if model == 'claude':
-            result = chat_with_claude(message, context, problem_type)
+            result = await chat_with_claude(message, context, problem_type)
         elif model == 'gpt4':
-            result = chat_with_gpt4(message, context, problem_type)
+            result = await chat_with_gpt4(message, context, problem_type)
         else:
             return jsonify({'error': 'Invalid model specified'}), 400
 
         return jsonify({'result': result})
     except Exception as e:
         error_msg = f"An error occurred: {str(e)}"
-        app.logger.error(error_msg)
-        app.logger.error(traceback.format_exc())
+        log_error('chat', e)
         return jsonify({'error': error_msg}), 500
 
+SOLVE_INSTRUCTIONS = "Format your response with numbered steps and make the final answer bold. Remove any unnecessary whitespace."
+
+def solve_system_prompt(problem_type):
+    # Both models get these instructions as the system prompt and only the question as the
+    # user turn, so the prompt is identical across models and users of a problem type
+    return f"You are a {problem_type} expert. Provide detailed and accurate solutions to {problem_type} problems. Solve the {problem_type} problem you are given. {SOLVE_INSTRUCTIONS}"
+
+def claude_system(text):
+    # Mark the static prefix cacheable; Anthropic bills cached reads at a fraction of input cost
+    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+
+def chat_system_prompt(problem_type):
+    return f"You are a {problem_type} expert. Provide detailed and accurate answers to {problem_type}-related questions."
+
+# System blocks are identical for every request of a problem type, so build each one once.
+# Keeping the prefix byte-stable also lets OpenAI's automatic prompt caching match it.
+@functools.lru_cache(maxsize=64)
+def gpt4_solve_system(problem_type):
+    return {"role": "system", "content": solve_system_prompt(problem_type)}
+
+@functools.lru_cache(maxsize=64)
+def gpt4_chat_system(problem_type):
+    return {"role": "system", "content": chat_system_prompt(problem_type)}
+
+@functools.lru_cache(maxsize=64)
+def claude_solve_system(problem_type):
+    return claude_system(solve_system_prompt(problem_type))
+
+@functools.lru_cache(maxsize=64)
+def claude_chat_system(problem_type):
+    return claude_system(chat_system_prompt(problem_type))
+
+def is_short_problem(problem_type, question):
+    return problem_type in COMPUTATIONAL_TYPES and len(question) <= SHORT_QUESTION_LENGTH
+
+def estimate_max_tokens(problem_type, question):
+    # Generation time is linear in output length, so don't leave room a short answer won't use
+    if problem_type not in COMPUTATIONAL_TYPES:
+        return 1200
+    return 400 if len(question) <= SHORT_QUESTION_LENGTH else 1000
+
+def truncated(text):
+    # Cut off at max_tokens: serve it if nothing better comes back, but never cache it
+    logging.info("Completion hit max_tokens")
+    return UncachedResult(format_response(text))
+
+async def solve_routed(provider, problem_type, question):
+    solver = solve_with_claude if provider == 'claude' else solve_with_gpt4
+    full_model = MODEL_TIERS[provider]['full']
+    max_tokens = estimate_max_tokens(problem_type, question)
+    if is_short_problem(problem_type, question):
+        result = await solver(problem_type, question, MODEL_TIERS[provider]['fast'], max_tokens)
+        if not result.startswith("Error:") and not isinstance(result, UncachedResult):
+            return result
+        # The fast model failed or ran out of budget; retry on the full model with room to finish
+        return await solver(problem_type, question, full_model, FULL_MAX_TOKENS)
+    result = await solver(problem_type, question, full_model, max_tokens)
+    if isinstance(result, UncachedResult):
+        return await solver(problem_type, question, full_model, FULL_MAX_TOKENS)
+    return result
+
+async def solve_with_llms(problem_type, question, mode='dual'):
+    if mode == 'fast':
+        if FAST_MODEL_BY_TYPE.get(problem_type, 'gpt4') == 'claude':
+            return await solve_routed('claude', problem_type, question), None
+        return None, await solve_routed('gpt4', problem_type, question)
+
+    # Both providers are independent network round-trips, so run them side by side
+    results = await asyncio.gather(
+        solve_routed('claude', problem_type, question),
+        solve_routed('gpt4', problem_type, question),
+        return_exceptions=True
+    )
+    return tuple(f"Error: {r}" if isinstance(r, Exception) else r for r in results)
+
+async def solve_locally(problem_type, question):
+    # sympy is CPU-bound, so it runs in worker processes that are killed if it runs long
+    try:
+        result = await local_solver_pool.solve(problem_type, question)
+    except Exception as e:
+        log_error('solve_locally', e)
+        return None
+    return format_response(result) if result is not None else None
+
 # Update the solve_with_claude and solve_with_gpt4 functions to handle business questions
-def solve_with_claude(problem_type, question):
-    prompt = f"{HUMAN_PROMPT} Solve the following {problem_type} problem: {question}. Format your response with numbered steps and make the final answer bold. Remove any unnecessary whitespace.{AI_PROMPT}"
+@cached()
+async def solve_with_claude(problem_type, question, model, max_tokens):
     try:
-        response = anthropic_client.completions.create(
-            model="claude-2",
-            prompt=prompt,
-            max_tokens_to_sample=1000
+        response = await anthropic_client.messages.create(
+            model=model,
+            system=claude_solve_system(problem_type),
+            messages=[{"role": "user", "content": question}],
+            max_tokens=max_tokens
         )
-        formatted_response = format_response(response.completion)
+        if response.stop_reason == "max_tokens":
+            return truncated(response.content[0].text)
+        formatted_response = format_response(response.content[0].text)
         return formatted_response
     except Exception as e:
-        logging.error(f"Error in solve_with_claude: {str(e)}")
+        log_error('solve_with_claude', e)
         return f"Error: {str(e)}"
 
-def solve_with_gpt4(problem_type, question):
-    prompt = f"Solve the following {problem_type} problem: {question}. Format your response with numbered steps and make the final answer bold. Remove any unnecessary whitespace."
+@cached()
+async def solve_with_gpt4(problem_type, question, model, max_tokens):
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4",
+        response = await openai_client.chat.completions.create(
+            model=model,
             messages=[
-                {"role": "system", "content": f"You are a {problem_type} expert. Provide detailed and accurate solutions to {problem_type} problems."},
-                {"role": "user", "content": prompt}
-            ]
+                gpt4_solve_system(problem_type),
+                {"role": "user", "content": question}
+            ],
+            max_tokens=max_tokens
         )
-        formatted_response = format_response(response.choices[0].message.content)
+        choice = response.choices[0]
+        if choice.finish_reason == "length":
+            return truncated(choice.message.content)
+        formatted_response = format_response(choice.message.content)
         return formatted_response
     except Exception as e:
-        logging.error(f"Error in solve_with_gpt4: {str(e)}")
+        log_error('solve_with_gpt4', e)
         return f"Error: {str(e)}"
 
+FINAL_ANSWER_PREFIX = 'final answer:'
+
 def format_response(response):
-    # Split the response into lines
-    lines = response.split('\n')
-    formatted_lines = []
-    
-    for line in lines:
-        line = line.strip()
-        if line.startswith('Step '):
-            formatted_lines.append(line)
-        elif line.lower().startswith('final answer:'):
-            formatted_lines.append(f"<strong>{line}</strong>")
-        elif line:
-            formatted_lines.append(line)
-    
-    return '<br>'.join(formatted_lines)
+    # Single pass over the lines: drop blanks and bold the final answer. 'Step' lines and
+    # everything else pass through as-is, and only the prefix is lowercased for the check.
+    lines = (line.strip() for line in response.split('\n'))
+    return '<br>'.join(
+        f"<strong>{line}</strong>" if line[:len(FINAL_ANSWER_PREFIX)].lower() == FINAL_ANSWER_PREFIX else line
+        for line in lines if line
+    )
+
+@cached_stream(finalize=format_response)
+async def stream_with_claude(problem_type, question, model):
+    async with anthropic_client.messages.stream(
+        model=model,
+        system=claude_solve_system(problem_type),
+        messages=[{"role": "user", "content": question}],
+        max_tokens=estimate_max_tokens(problem_type, question)
+    ) as stream:
+        async for text in stream.text_stream:
+            yield text
+        message = await stream.get_final_message()
+        if message.stop_reason == "max_tokens":
+            yield TRUNCATED
 
-def chat_with_claude(message, context, problem_type):
-    prompt = f"{HUMAN_PROMPT} {context}\nUser: {message}\nAssistant: As a {problem_type} expert, I'll help you with your question.{AI_PROMPT}"
+@cached_stream(finalize=format_response)
+async def stream_with_gpt4(problem_type, question, model):
+    stream = await openai_client.chat.completions.create(
+        model=model,
+        messages=[
+            gpt4_solve_system(problem_type),
+            {"role": "user", "content": question}
+        ],
+        max_tokens=estimate_max_tokens(problem_type, question),
+        stream=True
+    )
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            yield delta
+        if chunk.choices[0].finish_reason == "length":
+            yield TRUNCATED
+
+async def chat_with_claude(message, context, problem_type):
+    content = f"{context}\n\n{message}" if context else message
     try:
-        response = anthropic_client.completions.create(
-            model="claude-2",
-            prompt=prompt,
-            max_tokens_to_sample=1000
+        response = await anthropic_client.messages.create(
+            model=CLAUDE_MODEL,
+            system=claude_chat_system(problem_type),
+            messages=[{"role": "user", "content": content}],
+            max_tokens=1000
         )
-        return response.completion
+        return response.content[0].text
     except Exception as e:
-        logging.error(f"Error in chat_with_claude: {str(e)}")
+        log_error('chat_with_claude', e)
         return f"Error: {str(e)}"
 
-def chat_with_gpt4(message, context, problem_type):
+async def chat_with_gpt4(message, context, problem_type):
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4",
+        response = await openai_client.chat.completions.create(
+            model=GPT4_MODEL,
             messages=[
-                {"role": "system", "content": f"You are a {problem_type} expert. Provide detailed and accurate answers to {problem_type}-related questions."},
+                gpt4_chat_system(problem_type),
                 {"role": "assistant", "content": context},
                 {"role": "user", "content": message}
             ]
         )
         return response.choices[0].message.content
     except Exception as e:
-        logging.error(f"Error in chat_with_gpt4: {str(e)}")
+        log_error('chat_with_gpt4', e)
         return f"Error: {str(e)}"
 
 if __name__ == '__main__':
@@ -187,9 +480,14 @@ if __name__ == '__main__':
     logging.info(f"Starting application on port: {port}")
     
     try:
-        app.run(host='0.0.0.0', port=port, debug=False)
+        # Serve with Hypercorn rather than Quart's development server
+        from hypercorn.asyncio import serve
+        from hypercorn.config import Config
+
+        config = Config()
+        config.bind = [f"0.0.0.0:{port}"]
+        asyncio.run(serve(app, config))
     except Exception as e:
-        logging.error(f"Error starting the application: {e}")
-        logging.error(traceback.format_exc())
+        logging.exception(f"Error starting the application: {e}")
 
     logging.info("Application exiting.")
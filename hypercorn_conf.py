@@ -0,0 +1,14 @@
+import multiprocessing
+import os
+
+# Hypercorn settings, loaded with `hypercorn --config file:hypercorn_conf.py app:app`
+bind = [f"0.0.0.0:{os.getenv('PORT', 8000)}"]
+worker_class = "asyncio"
+# One asyncio worker per core already keeps hundreds of requests in flight. Each worker has
+# its own in-memory LLM cache and coalesces duplicate solves only among its own requests,
+# so set REDIS_URL to share cached answers across workers.
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# Each asyncio worker holds many in-flight LLM requests, so allow a deep accept queue
+backlog = 1000
+keep_alive_timeout = 75
+graceful_timeout = 120
@@ -0,0 +1,199 @@
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from typing import Optional, Protocol
+
+# Cached answers live for a day; solutions to a fixed problem don't go stale
+DEFAULT_TTL = 86400
+
+_SUPERSCRIPT_DIGITS = str.maketrans("⁰¹²³⁴⁵⁶⁷⁸⁹", "0123456789")
+_SUPERSCRIPT_RE = re.compile(r'[⁰¹²³⁴⁵⁶⁷⁸⁹]+')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+class UncachedResult(str):
+    """A solver result that is served but never stored, e.g. a completion cut off at max_tokens."""
+
+
+# Yielded by a streamer after its last delta when the completion was cut off
+TRUNCATED = object()
+
+
+class CacheBackend(Protocol):
+    async def get(self, key: str) -> Optional[str]:
+        ...
+
+    async def set(self, key: str, value: str, ttl: int = DEFAULT_TTL) -> None:
+        ...
+
+
+class MemoryBackend:
+    """Per-process cache, used when no Redis instance is configured."""
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._entries = {}
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            self._entries.pop(key, None)
+            return None
+        return value
+
+    async def set(self, key, value, ttl=DEFAULT_TTL):
+        if len(self._entries) >= self.max_entries:
+            # Drop the oldest insertion to stay bounded
+            self._entries.pop(next(iter(self._entries)))
+        self._entries[key] = (value, time.monotonic() + ttl)
+
+
+class RedisBackend:
+    """Shared cache across workers and containers."""
+
+    def __init__(self, url):
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url, decode_responses=True)
+
+    async def get(self, key):
+        return await self._redis.get(key)
+
+    async def set(self, key, value, ttl=DEFAULT_TTL):
+        await self._redis.set(key, value, ex=ttl)
+
+
+def _create_backend():
+    redis_url = os.getenv("REDIS_URL")
+    if redis_url:
+        logging.info("Using Redis LLM response cache")
+        return RedisBackend(redis_url)
+    return MemoryBackend()
+
+
+backend = _create_backend()
+
+# Solves currently waiting on a provider, by cache key and extra solver arguments
+_inflight = {}
+
+
+def normalize_expression(expression):
+    # Fold unicode superscripts into caret form so "x²" and "x^2" share a key
+    expression = _SUPERSCRIPT_RE.sub(
+        lambda m: '^' + m.group(0).translate(_SUPERSCRIPT_DIGITS),
+        expression
+    )
+    return _WHITESPACE_RE.sub(' ', expression.strip().lower())
+
+
+def cache_key(model, problem_type, expression):
+    payload = json.dumps({
+        "model": model,
+        "prompt_type": problem_type,
+        "expression": normalize_expression(expression)
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+async def _lookup(key, model, problem_type):
+    try:
+        hit = await backend.get(key)
+    except Exception as e:
+        logging.warning(f"LLM cache lookup failed: {str(e)}")
+        return None
+    if hit is not None:
+        logging.info(f"LLM cache hit - Model: {model}, Problem Type: {problem_type}")
+    return hit
+
+
+async def _store(key, result, ttl):
+    # Solvers report provider failures as text; never pin those or partial answers in the cache
+    if result.startswith("Error:") or isinstance(result, UncachedResult):
+        return
+    try:
+        await backend.set(key, result, ttl=ttl)
+    except Exception as e:
+        logging.warning(f"LLM cache store failed: {str(e)}")
+
+
+def cached(ttl=DEFAULT_TTL):
+    """Serve repeated (model, problem_type, expression) solves from the cache.
+
+    The wrapped solver takes (problem_type, question, model, *args); extra
+    arguments such as max_tokens are passed through but not part of the cache
+    key. Concurrent misses with the same key and arguments are coalesced onto
+    a single provider call.
+    """
+    def decorator(solver):
+        @functools.wraps(solver)
+        async def wrapper(problem_type, question, model, *args):
+            key = cache_key(model, problem_type, question)
+            hit = await _lookup(key, model, problem_type)
+            if hit is not None:
+                return hit
+
+            # Identical solves arriving while one is in flight share its provider call. The extra
+            # arguments are part of this key, so a retry with a bigger budget never joins a
+            # smaller call that may come back truncated.
+            inflight_key = (key, args)
+            task = _inflight.get(inflight_key)
+            if task is None:
+                task = asyncio.ensure_future(_solve_and_store(solver, key, problem_type, question, model, args, ttl))
+                _inflight[inflight_key] = task
+                task.add_done_callback(lambda _: _inflight.pop(inflight_key, None))
+            else:
+                logging.info(f"LLM request coalesced - Model: {model}, Problem Type: {problem_type}")
+            # Shielded so one client disconnecting doesn't cancel the call for the others
+            return await asyncio.shield(task)
+        return wrapper
+    return decorator
+
+
+async def _solve_and_store(solver, key, problem_type, question, model, args, ttl):
+    result = await solver(problem_type, question, model, *args)
+    await _store(key, result, ttl)
+    return result
+
+
+def cached_stream(finalize, ttl=DEFAULT_TTL):
+    """Cached counterpart of `cached` for solvers that yield text deltas.
+
+    The wrapper yields {"delta": ...} events as text arrives, then a single
+    {"result": ...} event holding `finalize` applied to the full text. A cache
+    hit yields only the result event. Results share keys with `cached`, so
+    streamed and buffered solves for the same model reuse each other's entries.
+    A streamer that yields TRUNCATED gets a result event flagged "truncated",
+    and that result is not cached.
+    """
+    def decorator(streamer):
+        @functools.wraps(streamer)
+        async def wrapper(problem_type, question, model):
+            key = cache_key(model, problem_type, question)
+            hit = await _lookup(key, model, problem_type)
+            if hit is not None:
+                yield {"result": hit}
+                return
+
+            chunks = []
+            truncated = False
+            async for delta in streamer(problem_type, question, model):
+                if delta is TRUNCATED:
+                    truncated = True
+                    continue
+                chunks.append(delta)
+                yield {"delta": delta}
+            result = finalize(''.join(chunks))
+            if truncated:
+                yield {"result": result, "truncated": True}
+                return
+            await _store(key, result, ttl)
+            yield {"result": result}
+        return wrapper
+    return decorator
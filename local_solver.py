@@ -0,0 +1,280 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+from typing import Optional
+
+import sympy
+from sympy.parsing.sympy_parser import (
+    parse_expr,
+    standard_transformations,
+    implicit_multiplication,
+    convert_xor
+)
+from sympy.core.function import AppliedUndef
+
+# Anything longer or outside this alphabet goes to the LLMs; parse_expr evals its input,
+# so only plain math notation is ever handed to it
+MAX_EXPRESSION_LENGTH = 200
+MAX_EXPONENT = 100
+LOCAL_PROBLEM_TYPES = ('derivative', 'integral', 'solve', 'math')
+_ALLOWED_RE = re.compile(r'^[0-9a-z\s+\-*/^().=]+$')
+# A dot outside a decimal number is attribute access, e.g. pi.evalf(300000) or 1 .evalf()
+_ATTRIBUTE_RE = re.compile(r'[a-z)]\s*\.|\.(?!\d)')
+_LEADING_VERB_RE = re.compile(r'^(solve|simplify|evaluate|calculate|compute|differentiate|integrate)\s+')
+
+# Juxtaposition like 2x is multiplication, but names are never split into letters, so
+# words such as "derivative" stay one symbol and get rejected
+_TRANSFORMATIONS = standard_transformations + (implicit_multiplication, convert_xor)
+
+# Results sympy can't state as a plain finite answer; the LLMs explain these better
+_DEGENERATE = (sympy.zoo, sympy.nan, sympy.oo, -sympy.oo, sympy.CRootOf)
+
+# parse_expr's namespace: sympy's constructors plus common functions, and no builtins
+_NAMESPACE = {
+    '__builtins__': {},
+    **{name: getattr(sympy, name) for name in (
+        'Symbol', 'Integer', 'Float', 'Rational', 'Function', 'Add', 'Mul', 'Pow',
+        'sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'exp', 'log', 'sqrt', 'pi'
+    )},
+    'ln': sympy.log,
+}
+
+
+def try_solve(problem_type, expression) -> Optional[str]:
+    """Solve simple problems with sympy.
+
+    Returns the solution as text for format_response, or None when the problem
+    should go to the LLMs instead.
+    """
+    text = _prepare(problem_type, expression)
+    return _solve_text(problem_type, text) if text is not None else None
+
+
+def _prepare(problem_type, expression):
+    # The plain expression to hand to sympy, or None if the problem isn't one we solve locally
+    if problem_type not in LOCAL_PROBLEM_TYPES:
+        return None
+    text = expression.strip().lower()
+    text = _LEADING_VERB_RE.sub('', text)
+    if len(text) > MAX_EXPRESSION_LENGTH or not _ALLOWED_RE.match(text) or _ATTRIBUTE_RE.search(text):
+        return None
+    return text
+
+
+def _solve_text(problem_type, text):
+    try:
+        if problem_type == 'derivative':
+            return _differentiate(text)
+        if problem_type == 'integral':
+            return _integrate(text)
+        if problem_type == 'solve' or (problem_type == 'math' and '=' in text):
+            return _solve(text)
+        if problem_type == 'math':
+            return _evaluate(text)
+    except Exception as e:
+        logging.info(f"Local solver fell through to LLMs: {str(e)}")
+    return None
+
+
+def _parse(text):
+    # Parse unevaluated first so power towers like 9^9^9 are rejected before sympy computes them
+    if not _is_bounded(parse_expr(text, global_dict=_NAMESPACE, transformations=_TRANSFORMATIONS, evaluate=False)):
+        raise ValueError("exponent too large")
+    return parse_expr(text, global_dict=_NAMESPACE, transformations=_TRANSFORMATIONS)
+
+
+def _is_bounded(expr):
+    for node in sympy.preorder_traversal(expr):
+        if isinstance(node, sympy.Pow) and node.exp.is_number:
+            if not node.exp.is_Number or abs(node.exp) > MAX_EXPONENT:
+                return False
+    return True
+
+
+def _variable(expr):
+    # Exactly one single-letter variable and no unknown functions, or the input
+    # wasn't the plain expression we expected
+    if expr.atoms(AppliedUndef):
+        return None
+    symbols = expr.free_symbols
+    if len(symbols) != 1:
+        return None
+    var = next(iter(symbols))
+    return var if len(var.name) == 1 else None
+
+
+def _is_degenerate(result):
+    return any(result.has(bad) for bad in _DEGENERATE)
+
+
+def _show(expr):
+    return str(expr).replace('**', '^')
+
+
+def _differentiate(text):
+    expr = _parse(text)
+    var = _variable(expr)
+    if var is None:
+        return None
+    result = sympy.simplify(sympy.diff(expr, var))
+    if _is_degenerate(result):
+        return None
+    return f"Step 1: Differentiate {_show(expr)} with respect to {var}.\nFinal answer: {_show(result)}"
+
+
+def _integrate(text):
+    expr = _parse(text)
+    var = _variable(expr)
+    if var is None:
+        return None
+    result = sympy.integrate(expr, var)
+    # sympy hands back an unevaluated Integral when it can't find a closed form
+    if result.has(sympy.Integral) or _is_degenerate(result):
+        return None
+    return f"Step 1: Integrate {_show(expr)} with respect to {var}.\nFinal answer: {_show(result)} + C"
+
+
+def _solve(text):
+    sides = text.split('=')
+    if len(sides) > 2:
+        return None
+    lhs = _parse(sides[0])
+    rhs = _parse(sides[1]) if len(sides) == 2 else sympy.Integer(0)
+    equation = sympy.Eq(lhs, rhs)
+    var = _variable(lhs - rhs)
+    if var is None:
+        return None
+    # solveset returns image sets for periodic solutions and condition sets when it gives
+    # up; only a complete, finite list of plain roots is served
+    solutions = sympy.solveset(equation, var)
+    if not isinstance(solutions, sympy.FiniteSet) or not solutions or _is_degenerate(solutions):
+        return None
+    answer = ', '.join(f"{var} = {_show(s)}" for s in solutions)
+    return f"Step 1: Solve {_show(lhs)} = {_show(rhs)} for {var}.\nFinal answer: {answer}"
+
+
+def _evaluate(text):
+    expr = _parse(text)
+    if expr.free_symbols or expr.atoms(AppliedUndef):
+        return None
+    result = sympy.nsimplify(expr)
+    if not result.is_number or _is_degenerate(result):
+        return None
+    answer = _show(result)
+    if not result.is_Integer:
+        answer += f" ≈ {sympy.N(result, 10)}"
+    return f"Step 1: Evaluate {text}.\nFinal answer: {answer}"
+
+
+class SolverPool:
+    """Runs try_solve in child processes that are killed when sympy runs too long.
+
+    sympy can't be interrupted, so a timed-out solve kills its worker and a fresh one
+    is started in the background. Workers are plain subprocesses speaking JSON lines
+    over stdin/stdout; multiprocessing.Pool refuses to start inside Hypercorn's
+    daemonic worker processes. Solves are never queued: when every worker is busy or
+    still starting, the problem goes straight to the LLMs.
+    """
+
+    def __init__(self, processes, timeout, max_results=2048):
+        self.processes = processes
+        self.timeout = timeout
+        self.max_results = max_results
+        # Answers for repeat problems, kept here since workers die on every timeout
+        self._results = {}
+        self._workers = set()
+        self._idle = []
+        self._spawning = set()
+
+    async def start(self):
+        # Fill the pool and wait until every worker has imported sympy
+        self._grow()
+        await asyncio.gather(*self._spawning)
+
+    async def solve(self, problem_type, expression):
+        # Screen and normalize here, so chat-style questions never cost a worker round trip
+        text = _prepare(problem_type, expression)
+        if text is None:
+            return None
+        key = (problem_type, text)
+        if key in self._results:
+            return self._results[key]
+        if not self._idle:
+            self._grow()
+            return None
+        worker = self._idle.pop()
+        line = b''
+        try:
+            worker.stdin.write(json.dumps([problem_type, text]).encode() + b'\n')
+            line = await asyncio.wait_for(worker.stdout.readline(), self.timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Local solve timed out, restarting solver worker - Problem Type: {problem_type}")
+        finally:
+            # An empty line means the worker died; anything unfinished leaves it mid-solve
+            if line:
+                self._idle.append(worker)
+            else:
+                self._discard(worker)
+        if not line:
+            return None
+        result = json.loads(line)
+        if len(self._results) >= self.max_results:
+            # Drop the oldest insertion to stay bounded
+            self._results.pop(next(iter(self._results)))
+        self._results[key] = result
+        return result
+
+    def _grow(self):
+        while len(self._workers) + len(self._spawning) < self.processes:
+            task = asyncio.ensure_future(self._spawn())
+            self._spawning.add(task)
+            task.add_done_callback(self._spawning.discard)
+
+    async def _spawn(self):
+        worker = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE
+        )
+        if await worker.stdout.readline():
+            self._workers.add(worker)
+            self._idle.append(worker)
+        else:
+            logging.warning(f"Local solver worker failed to start (exit code {await worker.wait()})")
+
+    def _discard(self, worker):
+        self._workers.discard(worker)
+        if worker in self._idle:
+            self._idle.remove(worker)
+        if worker.returncode is None:
+            worker.kill()
+        self._grow()
+
+    async def close(self):
+        # Let starting workers finish so none are left running unowned
+        await asyncio.gather(*self._spawning, return_exceptions=True)
+        workers, self._workers = self._workers, set()
+        self._idle.clear()
+        for worker in workers:
+            if worker.returncode is None:
+                worker.kill()
+        await asyncio.gather(*(worker.wait() for worker in workers))
+
+
+def _serve():
+    # Worker loop: one JSON [problem_type, expression] per line in, one JSON result per line out.
+    # Stray prints from sympy go to stderr so they can't corrupt the protocol.
+    out, sys.stdout = sys.stdout, sys.stderr
+    out.write('ready\n')
+    out.flush()
+    for line in sys.stdin:
+        problem_type, expression = json.loads(line)
+        out.write(json.dumps(try_solve(problem_type, expression)) + '\n')
+        out.flush()
+
+
+if __name__ == '__main__':
+    _serve()
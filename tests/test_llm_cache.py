@@ -0,0 +1,52 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_cache
+from llm_cache import UncachedResult, cached
+
+
+def _counting_solver():
+    calls = []
+
+    @cached()
+    async def solver(problem_type, question, model, max_tokens):
+        calls.append(max_tokens)
+        await asyncio.sleep(0.05)
+        if max_tokens < 2000:
+            return UncachedResult(f"cut off at {max_tokens}")
+        return f"answer with {max_tokens}"
+
+    return solver, calls
+
+
+def test_coalesces_identical_concurrent_solves(monkeypatch):
+    monkeypatch.setattr(llm_cache, 'backend', llm_cache.MemoryBackend())
+    solver, calls = _counting_solver()
+
+    async def run():
+        return await asyncio.gather(
+            solver('math', 'x^2', 'model', 2000),
+            solver('math', 'x^2', 'model', 2000)
+        )
+
+    assert asyncio.run(run()) == ['answer with 2000', 'answer with 2000']
+    assert calls == [2000]
+
+
+def test_retry_with_bigger_budget_does_not_join_smaller_call(monkeypatch):
+    monkeypatch.setattr(llm_cache, 'backend', llm_cache.MemoryBackend())
+    solver, calls = _counting_solver()
+
+    async def run():
+        first = asyncio.ensure_future(solver('math', 'x^2', 'model', 400))
+        await asyncio.sleep(0)
+        retry = await solver('math', 'x^2', 'model', 2000)
+        return await first, retry
+
+    first, retry = asyncio.run(run())
+    assert isinstance(first, UncachedResult)
+    assert retry == 'answer with 2000'
+    assert sorted(calls) == [400, 2000]
@@ -0,0 +1,145 @@
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from local_solver import SolverPool, try_solve
+
+
+@pytest.mark.parametrize('problem_type, expression, answer', [
+    ('derivative', 'x^2+2x', 'Final answer: 2*x + 2'),
+    ('derivative', 'ln(x)', 'Final answer: 1/x'),
+    ('integral', 'sin(x)', 'Final answer: -cos(x) + C'),
+    ('solve', 'x^2+2x+1=0', 'Final answer: x = -1'),
+    ('solve', 'solve 2x = 6', 'Final answer: x = 3'),
+    ('math', '1/3+1/4', 'Final answer: 7/12'),
+    ('math', '2+3*4', 'Final answer: 14'),
+    ('math', '0.5+.25', 'Final answer: 3/4'),
+])
+def test_solves_simple_problems(problem_type, expression, answer):
+    assert answer in try_solve(problem_type, expression)
+
+
+@pytest.mark.parametrize('problem_type, expression', [
+    # Words and unknown functions must not be split into single-letter symbols
+    ('derivative', 'derivative of x^2'),
+    ('derivative', 'd/dx x^2'),
+    ('derivative', 'sinh(x)'),
+    ('integral', 'x^2 dx'),
+    ('solve', 'abs(x)=1'),
+    ('math', 'e'),
+])
+def test_unparseable_input_falls_through(problem_type, expression):
+    assert try_solve(problem_type, expression) is None
+
+
+@pytest.mark.parametrize('problem_type, expression', [
+    ('math', '10/0'),
+    ('math', 'log(0)'),
+    ('math', 'tan(pi/2)'),
+    ('math', '0/0'),
+    ('solve', 'x^5 - x + 1 = 0'),
+    ('solve', 'sin(x)=0'),
+])
+def test_degenerate_results_fall_through(problem_type, expression):
+    assert try_solve(problem_type, expression) is None
+
+
+@pytest.mark.parametrize('expression', [
+    "__import__('os').system('ls')",
+    'open(x)',
+    'x.func',
+    'exec(x)',
+    # Method calls on sympy objects run arbitrary amounts of work inside parse_expr
+    'pi.evalf(300000)',
+    'pi .evalf(300000)',
+    '1 .evalf(300000)',
+    '(x+1).expand()',
+    '2.5.evalf(300000)',
+])
+def test_rejects_injection(expression):
+    assert try_solve('math', expression) is None
+
+
+@pytest.mark.parametrize('expression', ['9^9^9', '2^1000', '9**9**9'])
+def test_rejects_power_towers(expression):
+    start = time.monotonic()
+    assert try_solve('math', expression) is None
+    assert time.monotonic() - start < 1
+
+
+def test_ignores_other_problem_types():
+    assert try_solve('law', 'x+1') is None
+
+
+def test_pool_kills_runaway_solve_and_recovers():
+    async def run():
+        pool = SolverPool(processes=1, timeout=1)
+        try:
+            await pool.start()
+            start = time.monotonic()
+            assert await pool.solve('integral', 'exp(x)*sin(x)^7*log(x)*tan(x)') is None
+            assert time.monotonic() - start < 5
+            # A fresh worker replaces the killed one and picks up the next problem
+            await pool.start()
+            assert 'Final answer: 2*x' in await pool.solve('derivative', 'x^2')
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
+
+
+def test_pool_skips_solve_while_workers_start():
+    async def run():
+        pool = SolverPool(processes=1, timeout=1)
+        try:
+            assert await pool.solve('derivative', 'x^2') is None
+            await pool.start()
+            assert 'Final answer: 2*x' in await pool.solve('derivative', 'x^2')
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
+
+
+def test_pool_remembers_answers_across_worker_restarts():
+    async def run():
+        pool = SolverPool(processes=1, timeout=1)
+        try:
+            await pool.start()
+            assert 'Final answer: 2*x' in await pool.solve('derivative', 'x^2')
+            assert await pool.solve('integral', 'exp(x)*sin(x)^7*log(x)*tan(x)') is None
+            # The killed worker's replacement is still starting, but the answer is kept by the pool
+            assert 'Final answer: 2*x' in await pool.solve('derivative', 'x^2')
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
+
+
+def _solve_in_pool(results):
+    async def run():
+        pool = SolverPool(processes=1, timeout=5)
+        try:
+            await pool.start()
+            return await pool.solve('derivative', 'x^3')
+        finally:
+            await pool.close()
+
+    results.put(asyncio.run(run()))
+
+
+def test_pool_runs_inside_daemonic_process():
+    # Hypercorn's workers are daemonic, and daemonic processes can't start a multiprocessing.Pool
+    results = multiprocessing.Queue()
+    worker = multiprocessing.Process(target=_solve_in_pool, args=(results,), daemon=True)
+    worker.start()
+    try:
+        assert 'Final answer: 3*x^2' in results.get(timeout=30)
+    finally:
+        worker.join(timeout=5)